@@ -1,5 +1,24 @@
 import os
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
+
+# Module-level session so repeated uploads reuse the pooled TCP+TLS
+# connection to api.imgbb.com instead of paying a handshake per call.
+# Retries cover connection errors only; re-POSTing an upload on a 5xx
+# is not safe.
+_session = requests.Session()
+_session.mount("https://api.imgbb.com", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+))
+_session.headers.update({
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, br",
+})
 
 
 def upload_to_imgbb(image_path, api_key: str | None = None) -> str:
@@ -22,15 +41,23 @@ def upload_to_imgbb(image_path, api_key: str | None = None) -> str:
 
     try:
         with open(image_path, "rb") as f:
-            # Send as multipart/form-data. Provide a filename so the server
-            # receives a proper filename in the part.
-            files = {"image": (os.path.basename(image_path), f)}
-            data = {"key": api_key}
-            resp = requests.post(url, files=files, data=data, timeout=60)
+            # Send as multipart/form-data via MultipartEncoder, which
+            # streams the body straight from the file instead of building
+            # the whole multipart payload in memory (ImgBB ignores the part
+            # filename, so a generic one is fine).
+            f.seek(0)  # Defensive: ensure we stream from the start
+            encoder = MultipartEncoder(fields={
+                "key": api_key,
+                "image": ("image", f, "application/octet-stream"),
+            })
+            resp = _session.post(url, data=encoder,
+                                 headers={"Content-Type": encoder.content_type},
+                                 timeout=60)
 
-        # Attempt to decode JSON response
+        # Attempt to decode JSON response (orjson decodes in C, well faster
+        # than the stdlib json used by resp.json())
         try:
-            j = resp.json()
+            j = orjson.loads(resp.content)
         except Exception:
             return f"Error: {resp.status_code} - {resp.text}"
 
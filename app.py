@@ -1,10 +1,28 @@
+import io
 import os
 import time
-import base64
-import requests
+import random
+import asyncio
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import httpx
+import orjson
+from PIL import Image
 from flask import Flask, render_template, request, redirect, url_for, jsonify
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
+# pybase64 encodes with SIMD (AVX2/SSSE3), 3-4x faster than the stdlib on
+# the multi-MB buffers the inline image path produces.
+try:
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
+
 # --- Configuration ---
 # NOTE: The ImgBB API key MUST be set as an environment variable.
 # You can get one for free at https://api.imgbb.com/
@@ -14,6 +32,121 @@ IMG_BB_API_KEY = os.getenv("IMGBB_API_KEY")
 RUNPOD_ENDPOINT = "https://api.runpod.ai/v2/qwen-image-edit"
 RUNPOD_RUN_URL = f"{RUNPOD_ENDPOINT}/run"
 RUNPOD_STATUS_URL = f"{RUNPOD_ENDPOINT}/status"
+RUNPOD_STATUS_SYNC_URL = f"{RUNPOD_ENDPOINT}/status-sync"
+
+# Overall wall-clock budget for a single RunPod job (matches the previous
+# 100 polls x 3 s limit).
+RUNPOD_JOB_TIMEOUT = 300
+
+# Static part of the RunPod job payload, built once instead of per call;
+# run_qwen_image_edit copies it and fills in the variable fields.
+_RUNPOD_BASE_INPUT = {
+    "prompt": None,
+    "negative_prompt": "",
+    "seed": -1,
+    "image": None,
+    "output_format": "png",
+    "enable_safety_checker": True,
+}
+
+# ImgBB uploads go over a shared HTTP/2 client: ALPN negotiates h2 during
+# the same TLS handshake and the pooled connection is reused across
+# uploads, dropping HTTP/1.1's one-request-per-connection serialization.
+# Transport retries cover connect errors only — re-POSTing a multipart
+# upload after a 5xx is not safe. httpx decodes gzip/brotli transparently
+# (br needs the brotli package installed).
+_h2_client = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=8),
+    ),
+    timeout=30.0,
+    headers={
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip, br",
+    },
+)
+
+# All RunPod I/O runs on one background event loop (daemon thread) through a
+# single HTTP/2 client, so concurrent jobs multiplex their polls over one
+# TCP+TLS connection instead of each tying up a pooled socket. Flask views
+# stay synchronous and hand coroutines to the loop via _run_async.
+_async_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    timeout=httpx.Timeout(30.0, read=300.0),
+)
+_async_loop = asyncio.new_event_loop()
+threading.Thread(target=_async_loop.run_forever, name="runpod-io", daemon=True).start()
+
+def _run_async(coro):
+    """Runs a coroutine on the shared RunPod I/O loop and waits for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _async_loop).result()
+
+async def _warm_runpod_connection(runpod_key):
+    """
+    Primes the pooled connection to api.runpod.ai so the job submission
+    that follows skips the TCP+TLS handshake. The response is irrelevant;
+    only the established connection matters.
+    """
+    try:
+        await _async_client.head(
+            RUNPOD_RUN_URL,
+            headers={"Authorization": f"Bearer {runpod_key}"},
+            timeout=5,
+        )
+    except httpx.HTTPError:
+        pass
+
+# The upload + edit pipeline runs on this pool so /process can return a
+# job id immediately instead of occupying a request thread for up to five
+# minutes; the browser polls /job/<job_id> for the outcome.
+_executor = ThreadPoolExecutor(max_workers=16)
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def _warm_connections():
+    """
+    Establishes TLS connections to both APIs ahead of the first user
+    request, which would otherwise pay a full handshake (~100-300 ms) to
+    each host. Responses are irrelevant and failures harmless. Runs on the
+    worker pool so importing the module never blocks on the network; under
+    gunicorn each worker warms its own pools after forking.
+    """
+    try:
+        _h2_client.head("https://api.imgbb.com/", timeout=3)
+    except httpx.HTTPError:
+        pass
+    try:
+        asyncio.run_coroutine_threadsafe(
+            _async_client.head("https://api.runpod.ai/", timeout=3), _async_loop
+        ).result(timeout=5)
+    except Exception:
+        pass
+
+_executor.submit(_warm_connections)
+
+# Content-addressed cache of sha256(file bytes) -> hosted ImgBB URL, so
+# re-submitting the same image (common during prompt iteration) skips the
+# upload round-trip entirely. Bounded LRU, guarded for threaded servers.
+_URL_CACHE_MAX = 256
+_url_cache = OrderedDict()
+_url_cache_lock = threading.Lock()
+
+def _cache_get(digest):
+    with _url_cache_lock:
+        url = _url_cache.get(digest)
+        if url is not None:
+            _url_cache.move_to_end(digest)
+        return url
+
+def _cache_put(digest, url):
+    with _url_cache_lock:
+        _url_cache[digest] = url
+        _url_cache.move_to_end(digest)
+        while len(_url_cache) > _URL_CACHE_MAX:
+            _url_cache.popitem(last=False)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'a_secure_secret_key_for_session_management' # Required for production
@@ -21,6 +154,53 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Max 16MB file size
 
 # --- Helper Functions ---
 
+# Images below this size are uploaded as-is; re-encoding them would cost CPU
+# for little bandwidth gain.
+_SHRINK_THRESHOLD = 512 * 1024
+_MAX_EDGE = 2048
+
+# Images up to this size are sent to RunPod inline as a base64 data URI
+# instead of being hosted on ImgBB first.
+_INLINE_IMAGE_LIMIT = 4 * 1024 * 1024
+
+def _shrink_image(image_file):
+    """
+    Downscales and recompresses large uploads before they leave the server:
+    the longest edge is capped at 2048 px and the image re-encoded as
+    progressive JPEG (quality 85). Typical phone photos shrink 5-20x, which
+    cuts both the ImgBB upload and RunPod's fetch of the hosted image.
+    Returns the original FileStorage for small images or anything Pillow
+    cannot decode.
+    """
+    stream = image_file.stream
+    # Browsers rarely send Content-Length for multipart parts, so fall back
+    # to seeking the spooled stream; neither reads the file into memory.
+    size = image_file.content_length
+    if not size:
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+    stream.seek(0)
+    if size < _SHRINK_THRESHOLD:
+        return image_file
+
+    try:
+        img = Image.open(stream)
+        img.thumbnail((_MAX_EDGE, _MAX_EDGE), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")  # JPEG has no alpha/palette support
+
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85, optimize=True, progressive=True)
+    except Exception as e:
+        app.logger.warning(f"Image re-encode skipped ({e}); uploading original.")
+        stream.seek(0)
+        return image_file
+
+    buf.seek(0)
+    app.logger.info(f"Re-encoded upload from {size} to {buf.getbuffer().nbytes} bytes.")
+    filename = f"{os.path.splitext(image_file.filename or 'image')[0]}.jpg"
+    return FileStorage(stream=buf, filename=filename, content_type="image/jpeg")
+
 def upload_to_imgbb(image_file):
     """
     Uploads an image file to ImgBB and returns the hosted URL.
@@ -31,119 +211,201 @@ def upload_to_imgbb(image_file):
     app.logger.info("Uploading image to ImgBB...")
 
     try:
-        # ImgBB prefers the image as a base64 encoded string in the 'image' field
-        img_bytes = image_file.read()
-        base64_image = base64.b64encode(img_bytes)
-
-        # ImgBB API call
-        response = requests.post(
-            f"https://api.imgbb.com/1/upload?key={IMG_BB_API_KEY}",
-            data={
-                "image": base64_image,
-                "name": secure_filename(image_file.filename)
-            },
+        filename = secure_filename(image_file.filename)
+        image_file.stream.seek(0)
+
+        # Hash the stream in place (file_digest reads in chunks and releases
+        # the GIL) so duplicate submissions can be answered from the URL
+        # cache without re-uploading a single byte. The stream is already a
+        # disk-backed spool, so nothing is pulled fully into memory here.
+        digest = hashlib.file_digest(image_file.stream, 'sha256').hexdigest()
+
+        cached_url = _cache_get(digest)
+        if cached_url:
+            app.logger.info(f"ImgBB upload skipped (content cache hit). URL: {cached_url}")
+            return cached_url
+
+        image_file.stream.seek(0)
+
+        # Send the raw file as multipart/form-data instead of base64-encoding
+        # it: base64 inflates the payload by 33% and copies the whole image
+        # twice in memory. httpx's multipart encoder streams the body
+        # straight from the file object, so it is never materialized in RAM.
+        response = _h2_client.post(
+            "https://api.imgbb.com/1/upload",
+            params={"key": IMG_BB_API_KEY},
+            files={"image": (filename, image_file.stream, image_file.mimetype or "application/octet-stream")},
             timeout=30 # Set a timeout for the upload
         )
 
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
 
         if data.get('success'):
             hosted_url = data['data']['url']
+            _cache_put(digest, hosted_url)
             app.logger.info(f"ImgBB upload successful. URL: {hosted_url}")
             return hosted_url
         else:
             app.logger.error(f"ImgBB upload failed: {data.get('error', 'Unknown Error')}")
             raise Exception(f"ImgBB Upload Failed: {data.get('error', 'Unknown Error')}")
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         app.logger.error(f"HTTP Error during ImgBB upload: {e}")
         raise Exception(f"Network error with ImgBB: {e}")
     except Exception as e:
         app.logger.error(f"General Error during ImgBB upload: {e}")
         raise
 
-def run_qwen_image_edit(runpod_key, img_url, prompt, negative_prompt, seed):
+async def run_qwen_image_edit(runpod_key, img_url, prompt, negative_prompt, seed,
+                              image_bytes=None, image_mimetype="image/jpeg"):
     """
-    Submits the image URL and prompt to the RunPod Qwen Image Edit API and polls for the result.
+    Submits the image and prompt to the RunPod Qwen Image Edit API and
+    waits for the result. Runs on the shared RunPod I/O loop (see _run_async).
+
+    The image is normally passed by URL (img_url); alternatively, small
+    images can be passed as raw bytes (image_bytes), which are embedded in
+    the payload as a base64 data URI so no ImgBB hop is needed at all.
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {runpod_key}"
-    }
+    # Only the POST carries a body; the status GETs need just the auth header.
+    headers = {"Authorization": f"Bearer {runpod_key}"}
+    post_headers = {**headers, "Content-Type": "application/json"}
+
+    if image_bytes is not None:
+        image_ref = f"data:{image_mimetype};base64," + _b64encode(image_bytes).decode()
+    else:
+        image_ref = img_url
 
-    # Prepare the input payload for the RunPod API
+    # Fill the variable fields into a copy of the payload template
     payload = {
         "input": {
+            **_RUNPOD_BASE_INPUT,
             "prompt": prompt,
             "negative_prompt": negative_prompt,
             "seed": int(seed) if seed else -1, # Default seed to -1 if empty
-            "image": img_url,
-            "output_format": "png",
-            "enable_safety_checker": True
+            "image": image_ref,
         }
     }
 
     app.logger.info("Sending initial request to RunPod API...")
     # 1. Initial RunPod request to get the job ID
     try:
-        run_response = requests.post(RUNPOD_RUN_URL, headers=headers, json=payload, timeout=60)
+        run_response = await _async_client.post(RUNPOD_RUN_URL, headers=post_headers, content=orjson.dumps(payload), timeout=60)
         run_response.raise_for_status()
-        job_id = run_response.json().get('id')
-    except requests.exceptions.RequestException as e:
+        job_id = orjson.loads(run_response.content).get('id')
+    except httpx.HTTPError as e:
         app.logger.error(f"HTTP Error during initial RunPod request: {e}")
         raise Exception(f"RunPod API Error (Initial Request): {e}")
 
     if not job_id:
         raise Exception(f"RunPod API did not return a job ID. Response: {run_response.text}")
 
-    app.logger.info(f"RunPod job started, ID: {job_id}. Starting to poll...")
-    
-    # 2. Polling for job status
-    status = "IN_QUEUE"
-    max_polls = 100
-    polls = 0
-    
-    while status in ["IN_QUEUE", "IN_PROGRESS"] and polls < max_polls:
-        polls += 1
-        time.sleep(3) # Wait 3 seconds between polls
-        
+    app.logger.info(f"RunPod job started, ID: {job_id}. Waiting for completion...")
+
+    # 2. Wait for the job to finish (long-poll, with short-polling fallback)
+    return await _wait_for_job(job_id, headers)
+
+def _check_job_status(status_data, job_id):
+    """
+    Inspects a RunPod status payload. Returns the final image URL when the
+    job is COMPLETED, None while it is still queued/running, and raises on
+    FAILED/CANCELED or malformed output.
+    """
+    status = status_data.get('status')
+    app.logger.info(f"Job {job_id} status: {status}")
+
+    if status == "COMPLETED":
+        # The 'result' key inside 'output' contains the final image URL.
+        output = status_data.get('output')
+        final_image_url = output.get('result') if output and isinstance(output, dict) else None
+
+        if final_image_url:
+            return final_image_url
+        error_message = f"RunPod job COMPLETED but missing 'result' (final image URL) in output. Full output: {output}"
+        app.logger.error(error_message)
+        raise Exception(f"RunPod job output error: {error_message}")
+
+    if status in ["FAILED", "CANCELED"]:
+        error_message = status_data.get('error', f'Job failed with status: {status}')
+        app.logger.error(f"RunPod job failed: {error_message}")
+        raise Exception(f"RunPod job failed: {error_message}")
+
+    return None
+
+async def _wait_for_job(job_id, headers):
+    """
+    Long-polls RunPod's /status-sync endpoint, which holds the connection
+    open (up to 60 s server-side) until the job progresses. This removes
+    the fixed 3 s latency floor and the dozens of wasted round-trips of
+    short-polling; a job that finishes in 8 s returns in ~8 s plus one RTT.
+    Falls back to the classic /status short-poll loop if the endpoint is
+    unavailable (404/405).
+    """
+    deadline = time.monotonic() + RUNPOD_JOB_TIMEOUT
+
+    while time.monotonic() < deadline:
+        try:
+            status_response = await _async_client.get(
+                f"{RUNPOD_STATUS_SYNC_URL}/{job_id}",
+                headers=headers,
+                params={"wait": 60000},  # hold up to the 60 s server-side cap
+                timeout=90,
+            )
+            if status_response.status_code in (404, 405):
+                app.logger.info("status-sync not supported by endpoint; falling back to short-polling.")
+                return await _poll_job_status(job_id, headers, deadline)
+            status_response.raise_for_status()
+
+            final_image_url = _check_job_status(orjson.loads(status_response.content), job_id)
+            if final_image_url:
+                return final_image_url
+            # Server-side wait cap elapsed with the job still running:
+            # immediately re-issue the long-poll.
+
+        except httpx.HTTPError as e:
+            app.logger.error(f"HTTP Error during RunPod long-poll: {e}")
+            await asyncio.sleep(1)  # Brief pause before retrying the long-poll
+
+    raise Exception("RunPod job timed out (maximum wait time reached).")
+
+async def _poll_job_status(job_id, headers, deadline):
+    """
+    Legacy short-polling loop against /status, used only when the
+    status-sync long-poll endpoint is unavailable.
+
+    Polls with exponential backoff (0.5 s doubling to a 10 s cap) plus a
+    little jitter: fast jobs are noticed well before the old fixed 3 s
+    floor, while slow jobs generate far fewer wasted status requests. The
+    backoff resets once the job leaves the queue to stay responsive near
+    completion.
+    """
+    attempt = 0
+    last_status = None
+
+    while time.monotonic() < deadline:
+        delay = min(10.0, 0.5 * (2 ** min(attempt, 5))) + random.uniform(0, 0.3)
+        await asyncio.sleep(delay)
+        attempt += 1
+
         try:
-            status_response = requests.get(f"{RUNPOD_STATUS_URL}/{job_id}", headers=headers, timeout=10)
+            status_response = await _async_client.get(f"{RUNPOD_STATUS_URL}/{job_id}", headers=headers, timeout=10)
             status_response.raise_for_status()
-            status_data = status_response.json()
-            status = status_data.get('status')
-            
-            app.logger.info(f"Job {job_id} status: {status}")
-
-            if status == "COMPLETED":
-                # FIX: Check for the 'result' key, which contains the final image URL based on your error output.
-                output = status_data.get('output')
-                final_image_url = output.get('result') if output and isinstance(output, dict) else None
-
-                if final_image_url:
-                    return final_image_url
-                else:
-                    error_message = f"RunPod job COMPLETED but missing 'result' (final image URL) in output. Full output: {output}"
-                    app.logger.error(error_message)
-                    raise Exception(f"RunPod job output error: {error_message}")
-            
-            if status in ["FAILED", "CANCELED"]:
-                error_message = status_data.get('error', f'Job failed with status: {status}')
-                app.logger.error(f"RunPod job failed: {error_message}")
-                raise Exception(f"RunPod job failed: {error_message}")
-
-        except requests.exceptions.RequestException as e:
+            status_data = orjson.loads(status_response.content)
+
+            if status_data.get('status') != last_status:
+                # Progress (e.g. IN_QUEUE -> IN_PROGRESS): back off gently again.
+                last_status = status_data.get('status')
+                attempt = 1
+
+            final_image_url = _check_job_status(status_data, job_id)
+            if final_image_url:
+                return final_image_url
+
+        except httpx.HTTPError as e:
             app.logger.error(f"HTTP Error during RunPod polling: {e}")
             # Continue polling unless it's a critical error
-        except Exception as e:
-            app.logger.error(f"General Error during RunPod polling: {e}")
-            raise
 
-    if polls >= max_polls:
-        raise Exception("RunPod job timed out (maximum polling attempts reached).")
-    
-    return None # Should not happen if loop logic is correct
+    raise Exception("RunPod job timed out (maximum polling attempts reached).")
 
 # --- Routes ---
 
@@ -155,42 +417,113 @@ def index():
 
     return render_template('index.html', error_message=None, original_url=None, edited_url=None)
 
+def _pipeline(image_file, runpod_key, prompt, negative_prompt, seed):
+    """
+    Runs the full ImgBB upload + RunPod edit pipeline in a worker thread.
+    Returns the dict served by /job/<job_id>; errors are captured rather
+    than raised so the browser can display them.
+    """
+    original_url = None
+    edited_url = None
+    error_message = None
+
+    try:
+        # Step 1: Shrink oversized uploads
+        image_file = _shrink_image(image_file)
+
+        # Fast path: small images are embedded directly in the RunPod
+        # payload as a data URI, skipping the ImgBB round-trip entirely.
+        image_file.stream.seek(0, os.SEEK_END)
+        size = image_file.stream.tell()
+        image_file.stream.seek(0)
+
+        edited_url = None
+        if size <= _INLINE_IMAGE_LIMIT:
+            try:
+                edited_url = _run_async(run_qwen_image_edit(
+                    runpod_key, None, prompt, negative_prompt, seed,
+                    image_bytes=image_file.stream.read(),
+                    image_mimetype=image_file.mimetype or "image/jpeg",
+                ))
+            except Exception as e:
+                if "timed out" in str(e):
+                    raise
+                # Most likely the worker rejected the inline input format;
+                # retry through the hosted-URL path.
+                app.logger.warning(f"Inline image submission failed ({e}); falling back to ImgBB.")
+                image_file.stream.seek(0)
+
+        if edited_url is None:
+            # Step 2: Upload to ImgBB, then call RunPod with the hosted URL.
+            # The connection warm-up runs concurrently with the upload (they
+            # target different hosts), so the job submission right after the
+            # upload finds an already-established connection in the pool.
+            asyncio.run_coroutine_threadsafe(_warm_runpod_connection(runpod_key), _async_loop)
+            original_url = upload_to_imgbb(image_file)
+            edited_url = _run_async(run_qwen_image_edit(runpod_key, original_url, prompt, negative_prompt, seed))
+
+    except Exception as e:
+        error_message = str(e)
+        app.logger.error(f"Pipeline Failed: {error_message}")
+
+    return {
+        'original_url': original_url,
+        'edited_url': edited_url,
+        'error_message': error_message,
+    }
+
 @app.route('/process', methods=['POST'])
 def process():
-    """Handles the form submission and API pipeline."""
+    """Validates the form, queues the pipeline, and returns a job id."""
     runpod_key = request.form.get('runpod_key')
     prompt = request.form.get('prompt')
     negative_prompt = request.form.get('negative_prompt', "")
     seed = request.form.get('seed')
     image_file = request.files.get('image')
-    
+
     if not all([runpod_key, prompt, image_file]):
-        return render_template('index.html', error_message="Please fill in all required fields (Key, Prompt, and Image).", original_url=None, edited_url=None)
-    
+        return jsonify({'error': "Please fill in all required fields (Key, Prompt, and Image)."}), 400
+
     if not image_file.filename:
-         return render_template('index.html', error_message="Please select an image file to upload.", original_url=None, edited_url=None)
+        return jsonify({'error': "Please select an image file to upload."}), 400
 
-    original_url = None
-    edited_url = None
-    error_message = None
+    # Copy the upload out of the request context: the FileStorage stream is
+    # closed when this request ends, but the pipeline outlives it.
+    spool = tempfile.SpooledTemporaryFile(max_size=2 * 1024 * 1024)
+    image_file.stream.seek(0)
+    while True:
+        chunk = image_file.stream.read(64 * 1024)
+        if not chunk:
+            break
+        spool.write(chunk)
+    spool.seek(0)
+    file_copy = FileStorage(stream=spool, filename=image_file.filename, content_type=image_file.mimetype)
 
-    try:
-        # Step 1: Upload to ImgBB
-        original_url = upload_to_imgbb(image_file)
-        
-        # Step 2: Call RunPod API and poll for result
-        edited_url = run_qwen_image_edit(runpod_key, original_url, prompt, negative_prompt, seed)
+    job_id = uuid4().hex
+    future = _executor.submit(_pipeline, file_copy, runpod_key, prompt, negative_prompt, seed)
+    with _jobs_lock:
+        _jobs[job_id] = future
 
-    except Exception as e:
-        error_message = str(e)
-        app.logger.error(f"Pipeline Failed: {error_message}")
+    return jsonify({'job_id': job_id})
+
+@app.route('/job/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Reports the state of a queued pipeline run; the browser polls this."""
+    with _jobs_lock:
+        future = _jobs.get(job_id)
+
+    if future is None:
+        return jsonify({'error': 'Unknown job id.'}), 404
+
+    if not future.done():
+        return jsonify({'state': 'RUNNING' if future.running() else 'PENDING'})
+
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
 
-    return render_template('index.html', 
-                           error_message=error_message, 
-                           original_url=original_url, 
-                           edited_url=edited_url,
-                           # Pass back form data to re-populate the form on error
-                           form_data={'runpod_key': runpod_key, 'prompt': prompt, 'negative_prompt': negative_prompt, 'seed': seed})
+    result = future.result()
+    result['state'] = 'FINISHED'
+    return jsonify(result)
 
 if __name__ == '__main__':
     # For local development: ensure you set IMGBB_API_KEY in your environment